@@ -1,6 +1,13 @@
 import os
 import time
 import json
+import random
+import shutil
+import itertools
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -9,9 +16,15 @@ import pandas as pd
 from google.cloud import bigquery
 from torch.utils.data import DataLoader, TensorDataset
 from sklearn.preprocessing import LabelEncoder, StandardScaler
+from sklearn.metrics import roc_auc_score, log_loss
 from pathlib import Path
 from google.cloud import storage
 
+try:
+    import onnxruntime as ort
+except ImportError:  # sweep latency tie-breaks fall back to timing the torch model
+    ort = None
+
 # --- Configuration ---
 PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT", "node-quest-zbyang")
 DATASET_ID = os.getenv("BQ_DATASET", "analytics")
@@ -40,6 +53,24 @@ BATCH_SIZE = 1024
 EPOCHS = 5
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
+# Hyperparameter Sweep
+# SWEEP_MODE: "off" (train the constants above), "grid" (every combination
+# of SWEEP_SPACE) or "random" (combinations sampled from it). Both modes are
+# capped at SWEEP_TRIALS configs. SWEEP_SPACE can be overridden with a JSON
+# object in the env var of the same name; keys must be hyperparameter names.
+SWEEP_MODE = os.getenv("SWEEP_MODE", "off").lower()
+SWEEP_TRIALS = int(os.getenv("SWEEP_TRIALS", "8"))
+SWEEP_WORKERS = int(os.getenv("SWEEP_WORKERS", "0"))  # 0 = as many as CPU quota, memory (or GPUs) allow
+SWEEP_WORKER_MEMORY_MB = int(os.getenv("SWEEP_WORKER_MEMORY_MB", "1536"))  # interpreter + torch + one trial
+SWEEP_SEED = int(os.getenv("SWEEP_SEED", "42"))
+SWEEP_AUC_TOLERANCE = float(os.getenv("SWEEP_AUC_TOLERANCE", "0.001"))  # AUCs this close are ties
+SWEEP_LATENCY_RUNS = 200
+DEFAULT_SWEEP_SPACE = {
+    "embedding_dim": [8, 16],
+    "hidden_units": [[64, 32], [128, 64, 32]],
+    "learning_rate": [0.001, 0.003],
+}
+
 class DeepFM(nn.Module):
     def __init__(self, sparse_feature_dims, dense_feature_dim, embedding_dim=8, hidden_units=[64, 32], dropout=0.5):
         super(DeepFM, self).__init__()
@@ -225,12 +256,13 @@ def preprocess_data(df):
     
     return sparse_data, dense_data, labels_ctr, labels_cvr, splits, sparse_encoders, dense_scaler
 
-def export_onnx(model, sparse_dims, dense_dim, output_path, out_name='pctr'):
+def export_onnx(model, sparse_dims, dense_dim, output_path, out_name='pctr', device=None):
     print(f"Exporting ONNX model to {output_path}...")
     model.eval()
+    device = device or DEVICE
     
-    dummy_sparse = torch.zeros(1, len(sparse_dims), dtype=torch.long).to(DEVICE)
-    dummy_dense = torch.zeros(1, dense_dim, dtype=torch.float32).to(DEVICE)
+    dummy_sparse = torch.zeros(1, len(sparse_dims), dtype=torch.long).to(device)
+    dummy_dense = torch.zeros(1, dense_dim, dtype=torch.float32).to(device)
     
     torch.onnx.export(
         model,
@@ -258,12 +290,13 @@ def upload_to_gcs(source_file_path, destination_blob_name):
     blob.upload_from_filename(source_file_path)
     print(f"File uploaded to gs://{GCS_BUCKET_NAME}/{destination_blob_name}")
 
-def train_model(model, train_loader, X_val_sparse, X_val_dense, y_val, model_name="CTR"):
+def train_model(model, train_loader, X_val_sparse, X_val_dense, y_val, model_name="CTR",
+                learning_rate=LEARNING_RATE, epochs=EPOCHS):
     criterion = nn.BCELoss()
-    optimizer = optim.Adam(model.parameters(), lr=LEARNING_RATE)
+    optimizer = optim.Adam(model.parameters(), lr=learning_rate)
     
     print(f"--- Starting training {model_name} model on {DEVICE} ---")
-    for epoch in range(EPOCHS):
+    for epoch in range(epochs):
         model.train()
         total_loss = 0
         for batch_sparse, batch_dense, batch_y in train_loader:
@@ -288,10 +321,339 @@ def train_model(model, train_loader, X_val_sparse, X_val_dense, y_val, model_nam
                 val_loss = 0.0
                 accuracy = 0.0
             
-        print(f"[{model_name}] Epoch {epoch+1}/{EPOCHS} | Train Loss: {total_loss/len(train_loader):.4f} | Val Loss: {val_loss:.4f} | Val Acc: {accuracy:.4f}")
+        print(f"[{model_name}] Epoch {epoch+1}/{epochs} | Train Loss: {total_loss/len(train_loader):.4f} | Val Loss: {val_loss:.4f} | Val Acc: {accuracy:.4f}")
+    return model
+
+def default_config():
+    return {
+        "embedding_dim": EMBEDDING_DIM,
+        "hidden_units": DNN_HIDDEN_UNITS,
+        "dropout": DNN_DROPOUT,
+        "learning_rate": LEARNING_RATE,
+        "batch_size": BATCH_SIZE,
+        "epochs": EPOCHS,
+    }
+
+def build_model(sparse_dims, dense_dim, config, device=None):
+    return DeepFM(
+        sparse_dims, dense_dim, config["embedding_dim"], config["hidden_units"], config["dropout"]
+    ).to(device or DEVICE)
+
+def evaluate_model(model, X_val_sparse, X_val_dense, y_val):
+    """Validation AUC / logloss. Metrics that can't be computed (empty or single-class set) are None."""
+    if len(X_val_sparse) == 0:
+        return {"val_auc": None, "val_logloss": None}
+    model.eval()
+    with torch.no_grad():
+        preds = model(X_val_sparse.to(DEVICE), X_val_dense.to(DEVICE)).cpu().numpy()
+    labels = y_val.numpy()
+    auc = float(roc_auc_score(labels, preds)) if len(np.unique(labels)) > 1 else None
+    logloss = float(log_loss(labels, np.clip(preds, 1e-7, 1 - 1e-7), labels=[0.0, 1.0]))
+    return {"val_auc": auc, "val_logloss": logloss}
+
+def measure_latency_ms(model, sparse_dims, dense_dim, onnx_path):
+    """
+    Median batch-of-one latency on CPU with a single thread, so every contender is timed alike.
+    Times the exported ONNX model when onnxruntime is installed, the torch model otherwise.
+    """
+    model = model.cpu().eval()
+    sparse = np.zeros((1, len(sparse_dims)), dtype=np.int64)
+    dense = np.zeros((1, dense_dim), dtype=np.float32)
+    if ort is not None:
+        export_onnx(model, sparse_dims, dense_dim, onnx_path, device="cpu")
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = 1
+        options.inter_op_num_threads = 1
+        session = ort.InferenceSession(str(onnx_path), options, providers=["CPUExecutionProvider"])
+        feeds = {"sparse_inputs": sparse, "dense_inputs": dense}
+        run = lambda: session.run(None, feeds)
+    else:
+        sparse_t, dense_t = torch.from_numpy(sparse), torch.from_numpy(dense)
+        run = lambda: model(sparse_t, dense_t)
+
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    timings = []
+    try:
+        with torch.no_grad():
+            for i in range(SWEEP_LATENCY_RUNS + 10):
+                start = time.perf_counter()
+                run()
+                if i >= 10:  # skip warm-up runs
+                    timings.append((time.perf_counter() - start) * 1000)
+    finally:
+        torch.set_num_threads(num_threads)
+    return float(np.median(timings))
+
+def _is_positive_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+# Element checks for SWEEP_SPACE values, keyed like default_config()
+SWEEP_VALUE_CHECKS = {
+    "embedding_dim": (_is_positive_int, "a positive int"),
+    "hidden_units": (lambda v: isinstance(v, list) and len(v) > 0 and all(_is_positive_int(u) for u in v),
+                     "a non-empty list of positive ints"),
+    "dropout": (lambda v: _is_number(v) and 0 <= v < 1, "a number in [0, 1)"),
+    "learning_rate": (lambda v: _is_number(v) and v > 0, "a positive number"),
+    "batch_size": (_is_positive_int, "a positive int"),
+    "epochs": (_is_positive_int, "a positive int"),
+}
+
+def sweep_configs():
+    raw = os.getenv("SWEEP_SPACE")
+    space = json.loads(raw) if raw else DEFAULT_SWEEP_SPACE
+    if not isinstance(space, dict) or not space:
+        raise ValueError("SWEEP_SPACE must be a non-empty JSON object")
+    unknown = sorted(set(space) - set(SWEEP_VALUE_CHECKS))
+    if unknown:
+        raise ValueError(f"Unknown SWEEP_SPACE keys {unknown}, expected any of {sorted(SWEEP_VALUE_CHECKS)}")
+    for key, values in space.items():
+        if not isinstance(values, list) or not values:
+            raise ValueError(f"SWEEP_SPACE[{key!r}] must be a non-empty list")
+        check, expected = SWEEP_VALUE_CHECKS[key]
+        bad = [v for v in values if not check(v)]
+        if bad:
+            raise ValueError(f"SWEEP_SPACE[{key!r}] values must each be {expected}, got {bad}")
+
+    keys = list(space.keys())
+    grid = [dict(zip(keys, values)) for values in itertools.product(*(space[k] for k in keys))]
+    if SWEEP_MODE == "random" or len(grid) > SWEEP_TRIALS:
+        if SWEEP_MODE == "grid":
+            print(f"Warning: SWEEP_SPACE has {len(grid)} combinations. Sampling SWEEP_TRIALS={SWEEP_TRIALS} of them.")
+        grid = random.Random(SWEEP_SEED).sample(grid, min(SWEEP_TRIALS, len(grid)))
+    return [{**default_config(), **config} for config in grid]
+
+def _read_cgroup(path):
+    try:
+        with open(path) as f:
+            return f.read().split()
+    except OSError:
+        return None
+
+def available_cores():
+    """CPUs this process may use, honouring the container's cgroup quota (affinity alone ignores it)."""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    quota = _read_cgroup("/sys/fs/cgroup/cpu.max")  # cgroup v2: "<quota> <period>" or "max <period>"
+    if quota is None:
+        v1_quota = _read_cgroup("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+        v1_period = _read_cgroup("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+        if v1_quota and v1_period:
+            quota = [v1_quota[0], v1_period[0]]
+    if quota and quota[0] not in ("max", "-1"):
+        cores = min(cores, max(1, int(quota[0]) // int(quota[1])))
+    return cores
+
+def available_memory_bytes():
+    """Memory limit of the container (cgroup v2 or v1), or physical memory when unlimited."""
+    limit = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        value = _read_cgroup(path)
+        if value and value[0] != "max":
+            limit = min(limit, int(value[0]))
+            break
+    return limit
+
+def share_ctr_arrays(sparse_x, dense_x, y_ctr, train_mask, val_mask):
+    """
+    Gathers the CTR train/validation rows straight into shared memory blocks, so the
+    parent holds no CTR copy besides the workers' shared one. Returns the blocks and
+    the specs workers use to re-attach them.
+    """
+    layout = {}
+    for split, mask in (("train", train_mask), ("val", val_mask)):
+        rows = np.flatnonzero(mask)
+        for name, src, dtype in (("sparse", sparse_x, np.int64), ("dense", dense_x, np.float32), ("y", y_ctr, np.float32)):
+            shape = (len(rows),) + src.shape[1:]
+            nbytes = int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+            layout[f"{split}_{name}"] = (src, rows, shape, np.dtype(dtype), nbytes)
+
+    # Writing past a full /dev/shm is a SIGBUS, not a Python error, so check the size up front
+    total = sum(nbytes for *_, nbytes in layout.values())
+    if os.path.isdir("/dev/shm"):
+        free = shutil.disk_usage("/dev/shm").free
+        if total > free:
+            raise RuntimeError(
+                f"Sweep needs {total / 2**20:.0f} MB of shared memory but /dev/shm has {free / 2**20:.0f} MB free. "
+                "Give the container a larger /dev/shm (e.g. docker run --shm-size) or set SWEEP_MODE=off."
+            )
+
+    blocks, specs = [], {}
+    try:
+        for name, (src, rows, shape, dtype, nbytes) in layout.items():
+            shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+            blocks.append(shm)
+            view = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            # Gather in chunks so no full-size temporary copy is made
+            chunk = 1 << 20
+            for i in range(0, len(rows), chunk):
+                view[i:i + chunk] = src[rows[i:i + chunk]]
+            view = None  # the block can't be closed while a view exports its buffer
+            specs[name] = (shm.name, shape, dtype.str)
+    except BaseException:
+        view = None
+        release_shared(blocks)
+        raise
+    return blocks, specs
+
+def release_shared(blocks):
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
+
+# Per-worker state, populated by _init_sweep_worker
+_SWEEP_BLOCKS = []
+_SWEEP_DATA = {}
+
+def _init_sweep_worker(specs, num_threads):
+    torch.set_num_threads(num_threads)
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _SWEEP_BLOCKS.append(shm)  # keep the mapping alive for the tensor below
+        _SWEEP_DATA[name] = torch.from_numpy(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+def _trial_record(trial_id, config, error=None):
+    return {
+        "trial_id": trial_id, "config": config, "val_auc": None, "val_logloss": None,
+        "latency_ms": None, "checkpoint": None, "error": error
+    }
+
+def _run_sweep_trial(args):
+    global DEVICE
+    trial_id, config, sparse_dims, dense_dim, checkpoint_dir, device_id = args
+    result = _trial_record(trial_id, config)
+    # A diverging or otherwise broken config must not take the rest of the sweep down with it
+    try:
+        if device_id is not None:
+            # The GPU comes with the task, so a replacement worker needs no setup to pick one
+            torch.cuda.set_device(device_id)
+            DEVICE = f"cuda:{device_id}"
+        torch.manual_seed(SWEEP_SEED + trial_id)
+        data = _SWEEP_DATA
+        train_dataset = TensorDataset(data["train_sparse"], data["train_dense"], data["train_y"])
+        train_loader = DataLoader(train_dataset, batch_size=config["batch_size"], shuffle=True)
+        model = build_model(sparse_dims, dense_dim, config)
+        model = train_model(
+            model, train_loader, data["val_sparse"], data["val_dense"], data["val_y"],
+            f"CTR trial {trial_id}", config["learning_rate"], config["epochs"]
+        )
+        result.update(evaluate_model(model, data["val_sparse"], data["val_dense"], data["val_y"]))
+        checkpoint_path = Path(checkpoint_dir) / f"trial_{trial_id}.pt"
+        torch.save(model.state_dict(), checkpoint_path)
+        result["checkpoint"] = str(checkpoint_path)
+        print(f"[Sweep] Trial {trial_id} done | AUC: {result['val_auc']} | Logloss: {result['val_logloss']}")
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        print(f"[Sweep] Trial {trial_id} failed: {result['error']}")
+    return result
+
+def load_trial(result, sparse_dims, dense_dim, device):
+    model = build_model(sparse_dims, dense_dim, result["config"], device)
+    model.load_state_dict(torch.load(result["checkpoint"], map_location=device))
     return model
 
+def select_best_trial(results, sparse_dims, dense_dim, checkpoint_dir):
+    """
+    Highest validation AUC among the successful trials wins. Trials within SWEEP_AUC_TOLERANCE
+    of it are timed here, after training has finished, and the fastest one wins.
+    Returns None when no trial produced a validation metric to choose by.
+    """
+    succeeded = [r for r in results if r["error"] is None]
+    scored = [r for r in succeeded if r["val_auc"] is not None]
+    if not scored:
+        with_logloss = [r for r in succeeded if r["val_logloss"] is not None]
+        if not with_logloss:
+            print("Warning: No validation metrics (empty validation split), the sweep has no signal.")
+            return None
+        return min(with_logloss, key=lambda r: r["val_logloss"])
+
+    best_auc = max(r["val_auc"] for r in scored)
+    contenders = [r for r in scored if r["val_auc"] >= best_auc - SWEEP_AUC_TOLERANCE]
+    if len(contenders) == 1:
+        return contenders[0]
+    print(f"Timing {len(contenders)} trials within {SWEEP_AUC_TOLERANCE} AUC of the best...")
+    for r in contenders:
+        model = load_trial(r, sparse_dims, dense_dim, "cpu")
+        r["latency_ms"] = measure_latency_ms(model, sparse_dims, dense_dim, checkpoint_dir / f"trial_{r['trial_id']}.onnx")
+    return min(contenders, key=lambda r: (r["latency_ms"], r["val_logloss"]))
+
+def run_sweep(configs, sparse_x, dense_x, y_ctr, train_mask, val_mask, sparse_dims, dense_dim, output_dir):
+    """
+    Trains every sweep config on the CTR rows in a process pool and writes sweep_results.json.
+    Returns (best config, its trained model, all results); the first two are None when the
+    trials have no validation metric to choose by. Raises if every trial failed.
+    """
+    cores = available_cores()
+    memory_workers = max(1, available_memory_bytes() // (SWEEP_WORKER_MEMORY_MB * 2**20) - 1)  # minus the parent
+    gpus = max(1, torch.cuda.device_count()) if DEVICE == "cuda" else None
+    workers = max(1, min(SWEEP_WORKERS or gpus or cores, gpus or cores, memory_workers, len(configs)))
+    threads_per_worker = max(1, cores // workers)
+    checkpoint_dir = output_dir / "sweep"
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)  # drop checkpoints left by earlier runs
+    checkpoint_dir.mkdir()
+    print(f"--- Starting {SWEEP_MODE} sweep: {len(configs)} configs on {workers} workers x {threads_per_worker} threads ---")
+
+    tasks = [
+        (i, config, sparse_dims, dense_dim, str(checkpoint_dir), None if gpus is None else i % gpus)
+        for i, config in enumerate(configs)
+    ]
+    results = {}
+    blocks, specs = share_ctr_arrays(sparse_x, dense_x, y_ctr, train_mask, val_mask)
+    try:
+        # spawn rather than fork: forked children inherit torch/CUDA thread state and can deadlock
+        ctx = mp.get_context("spawn")
+        with ProcessPoolExecutor(workers, mp_context=ctx, initializer=_init_sweep_worker,
+                                 initargs=(specs, threads_per_worker)) as pool:
+            futures = {pool.submit(_run_sweep_trial, task): task for task in tasks}
+            for future in as_completed(futures):
+                trial_id, config = futures[future][:2]
+                try:
+                    results[trial_id] = future.result()
+                except BrokenProcessPool:
+                    # A worker died (OOM kill, segfault); every trial still pending is lost with it
+                    results[trial_id] = _trial_record(trial_id, config, "BrokenProcessPool: sweep worker died")
+                    print(f"[Sweep] Trial {trial_id} lost: a sweep worker died")
+    finally:
+        release_shared(blocks)
+    results = [results[i] for i in sorted(results)]
+
+    best = None
+    if any(r["error"] is None for r in results):
+        best = select_best_trial(results, sparse_dims, dense_dim, checkpoint_dir)
+    model = None
+    if best is not None:
+        latency = "n/a" if best["latency_ms"] is None else f"{best['latency_ms']:.3f}ms"
+        print(f"Best sweep config (trial {best['trial_id']}): {best['config']} | AUC: {best['val_auc']} | Latency: {latency}")
+        model = load_trial(best, sparse_dims, dense_dim, DEVICE)
+
+    # Keep only the winning checkpoint
+    for r in results:
+        if r is not best and r["checkpoint"] is not None:
+            Path(r["checkpoint"]).unlink(missing_ok=True)
+            r["checkpoint"] = None
+    for onnx_path in checkpoint_dir.glob("*.onnx"):
+        onnx_path.unlink()
+
+    with open(output_dir / "sweep_results.json", "w") as f:
+        json.dump(results, f, indent=2)
+    if all(r["error"] is not None for r in results):
+        raise RuntimeError(f"Every sweep trial failed, see {output_dir / 'sweep_results.json'}. No model was published.")
+
+    return (best["config"] if best is not None else None), model, results
+
 def main():
+    # Validate the sweep space before paying for the BigQuery load
+    sweep = SWEEP_MODE in ("grid", "random")
+    if sweep:
+        configs = sweep_configs()
+    elif SWEEP_MODE != "off":
+        print(f"Warning: Unknown SWEEP_MODE '{SWEEP_MODE}'. Training default config.")
+
     # 1. Load
     df = load_data_from_bq()
     if df.empty:
@@ -304,15 +666,6 @@ def main():
     train_mask = splits == 'TRAIN'
     val_mask = splits == 'VALIDATE'
     
-    # --- CTR Data ---
-    X_train_sparse_ctr = torch.tensor(sparse_x[train_mask], dtype=torch.long)
-    X_train_dense_ctr = torch.tensor(dense_x[train_mask], dtype=torch.float32)
-    y_train_ctr = torch.tensor(y_ctr[train_mask], dtype=torch.float32)
-    
-    X_val_sparse_ctr = torch.tensor(sparse_x[val_mask], dtype=torch.long)
-    X_val_dense_ctr = torch.tensor(dense_x[val_mask], dtype=torch.float32)
-    y_val_ctr = torch.tensor(y_ctr[val_mask], dtype=torch.float32)
-    
     # --- CVR Data (Only Clicked Requests) ---
     cvr_train_mask = train_mask & (y_ctr == 1.0)
     cvr_val_mask = val_mask & (y_ctr == 1.0)
@@ -327,29 +680,59 @@ def main():
     
     sparse_dims = [len(enc.classes_) for enc in encoders.values()]
     dense_dim = len(DENSE_FEATURES)
-    print(f"Model Config: Sparse Dims={sparse_dims}, Dense Dim={dense_dim}, Embedding Dim={EMBEDDING_DIM}")
 
-    # 3. Train CTR Model
-    train_dataset_ctr = TensorDataset(X_train_sparse_ctr, X_train_dense_ctr, y_train_ctr)
-    train_loader_ctr = DataLoader(train_dataset_ctr, batch_size=BATCH_SIZE, shuffle=True)
-    model_ctr = DeepFM(sparse_dims, dense_dim, EMBEDDING_DIM, DNN_HIDDEN_UNITS, DNN_DROPOUT).to(DEVICE)
-    model_ctr = train_model(model_ctr, train_loader_ctr, X_val_sparse_ctr, X_val_dense_ctr, y_val_ctr, "CTR")
+    output_dir = Path("artifacts_deepfm")
+    output_dir.mkdir(exist_ok=True)
+
+    # 3. Train CTR Model (optionally sweeping hyperparameters first)
+    config = default_config()
+    model_ctr = None
+    sweep_results = None
+    if sweep:
+        # The sweep gathers the CTR rows into shared memory itself, so no CTR tensors exist during it
+        best_config, model_ctr, sweep_results = run_sweep(
+            configs, sparse_x, dense_x, y_ctr, train_mask, val_mask, sparse_dims, dense_dim, output_dir
+        )
+        if best_config is not None:
+            config = best_config
+        else:
+            print("Warning: Sweep produced no usable trial. Training default config.")
+
+    print(f"Model Config: Sparse Dims={sparse_dims}, Dense Dim={dense_dim}, Hyperparameters={config}")
+
+    if model_ctr is None:
+        # --- CTR Data ---
+        X_train_sparse_ctr = torch.tensor(sparse_x[train_mask], dtype=torch.long)
+        X_train_dense_ctr = torch.tensor(dense_x[train_mask], dtype=torch.float32)
+        y_train_ctr = torch.tensor(y_ctr[train_mask], dtype=torch.float32)
+
+        X_val_sparse_ctr = torch.tensor(sparse_x[val_mask], dtype=torch.long)
+        X_val_dense_ctr = torch.tensor(dense_x[val_mask], dtype=torch.float32)
+        y_val_ctr = torch.tensor(y_ctr[val_mask], dtype=torch.float32)
+
+        train_dataset_ctr = TensorDataset(X_train_sparse_ctr, X_train_dense_ctr, y_train_ctr)
+        train_loader_ctr = DataLoader(train_dataset_ctr, batch_size=config["batch_size"], shuffle=True)
+        model_ctr = build_model(sparse_dims, dense_dim, config)
+        model_ctr = train_model(
+            model_ctr, train_loader_ctr, X_val_sparse_ctr, X_val_dense_ctr, y_val_ctr, "CTR",
+            config["learning_rate"], config["epochs"]
+        )
     
-    # 4. Train CVR Model
+    # 4. Train CVR Model (with the CTR hyperparameters)
     if len(X_train_sparse_cvr) > 0:
-        cvr_batch_size = min(BATCH_SIZE, max(1, len(X_train_sparse_cvr) // 2))
+        cvr_batch_size = min(config["batch_size"], max(1, len(X_train_sparse_cvr) // 2))
         train_dataset_cvr = TensorDataset(X_train_sparse_cvr, X_train_dense_cvr, y_train_cvr)
         train_loader_cvr = DataLoader(train_dataset_cvr, batch_size=cvr_batch_size, shuffle=True)
-        model_cvr = DeepFM(sparse_dims, dense_dim, EMBEDDING_DIM, DNN_HIDDEN_UNITS, DNN_DROPOUT).to(DEVICE)
-        model_cvr = train_model(model_cvr, train_loader_cvr, X_val_sparse_cvr, X_val_dense_cvr, y_val_cvr, "CVR")
+        model_cvr = build_model(sparse_dims, dense_dim, config)
+        model_cvr = train_model(
+            model_cvr, train_loader_cvr, X_val_sparse_cvr, X_val_dense_cvr, y_val_cvr, "CVR",
+            config["learning_rate"], config["epochs"]
+        )
     else:
         print("Warning: No clicked samples found for CVR training. Skipping CVR model.")
         model_cvr = None
 
     # 5. Save & Upload
-    output_dir = Path("artifacts_deepfm")
-    output_dir.mkdir(exist_ok=True)
-    
     feature_config = {
         "sparse_features": SPARSE_FEATURES,
         "dense_features": DENSE_FEATURES,
@@ -357,11 +740,14 @@ def main():
         "dense_means": scaler.mean_.tolist(),
         "dense_stds": scaler.scale_.tolist(),
         "label_encoders": {k: list(v.classes_) for k, v in encoders.items()},
-        "model_type": "deepfm"
+        "model_type": "deepfm",
+        "hyperparameters": config
     }
     config_path = output_dir / "feature_config.json"
     with open(config_path, "w") as f:
         json.dump(feature_config, f)
+
+    sweep_path = output_dir / "sweep_results.json"  # written by run_sweep
         
     onnx_ctr_path = output_dir / "deepfm_ctr.onnx"
     export_onnx(model_ctr, sparse_dims, dense_dim, onnx_ctr_path, out_name='pctr')
@@ -376,6 +762,8 @@ def main():
         upload_to_gcs(str(onnx_ctr_path), "models/pctr/deepfm_model_latest.onnx")
         upload_to_gcs(str(config_path), f"models/pctr/feature_config_deepfm_{timestamp}.json")
         upload_to_gcs(str(config_path), "models/pctr/feature_config_deepfm_latest.json")
+        if sweep_results is not None:
+            upload_to_gcs(str(sweep_path), f"models/pctr/sweep_results_deepfm_{timestamp}.json")
         
         if model_cvr is not None:
             upload_to_gcs(str(onnx_cvr_path), f"models/pcvr/deepfm_model_{timestamp}.onnx")